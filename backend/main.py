@@ -10,14 +10,18 @@ This server acts as a bridge between the frontend and GPU worker.
 
 import os
 import io
-import base64
+import sys
 import logging
 import asyncio
 import aiohttp
+from urllib.parse import quote
+import imagesize
+import pybase64
+from contextlib import asynccontextmanager
 from typing import Optional
-from PIL import Image
 from fastapi import FastAPI, HTTPException, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 
 # Configure logging
@@ -27,11 +31,33 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Shared HTTP session to the GPU worker (pooled keep-alive connections)
+gpu_session: Optional[aiohttp.ClientSession] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Manage application lifespan"""
+    global gpu_session
+    
+    # Startup
+    logger.info(f"⚡ Event loop: {type(asyncio.get_running_loop()).__module__}")
+    gpu_session = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=30),
+        connector=aiohttp.TCPConnector(limit=64, keepalive_timeout=60)
+    )
+    
+    yield
+    
+    # Shutdown
+    await gpu_session.close()
+
 # Create FastAPI app
 app = FastAPI(
     title="SmolVLM Caption Backend",
     description="Backend API for SmolVLM image captioning service", 
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Configure CORS for frontend access
@@ -61,61 +87,68 @@ class HealthResponse(BaseModel):
     gpu_worker_url: str
 
 # Utility functions
+def detect_image_format(image_data: bytes) -> Optional[str]:
+    """Detect JPEG/PNG/WEBP from magic bytes"""
+    if image_data[:3] == b'\xff\xd8\xff':
+        return 'JPEG'
+    if image_data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'PNG'
+    if image_data[:4] == b'RIFF' and image_data[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
 def validate_image(image_data: bytes) -> bool:
-    """Validate uploaded image"""
+    """Validate uploaded image from its header only (pixels are decoded by the GPU worker)"""
+    if not image_data or len(image_data) > MAX_IMAGE_SIZE:
+        return False
+    
+    # Check format
+    if detect_image_format(image_data) is None:
+        return False
+    
+    # Check dimensions (imagesize reads them straight from the header)
     try:
-        if len(image_data) > MAX_IMAGE_SIZE:
-            return False
-        
-        # Try to open with PIL
-        image = Image.open(io.BytesIO(image_data))
-        
-        # Check format
-        if image.format not in ['JPEG', 'JPG', 'PNG', 'WEBP']:
-            return False
-            
-        # Check dimensions
-        width, height = image.size
-        if width < 32 or height < 32 or width > 4096 or height > 4096:
-            return False
-            
-        return True
+        width, height = imagesize.get(io.BytesIO(image_data))
     except Exception:
         return False
+    
+    if width < 32 or height < 32 or width > 4096 or height > 4096:
+        return False
+        
+    return True
 
 async def check_gpu_worker_health() -> dict:
     """Check if GPU worker is healthy"""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{GPU_WORKER_URL}/health", timeout=5) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    return {"status": "unhealthy", "error": f"HTTP {response.status}"}
+        async with gpu_session.get(f"{GPU_WORKER_URL}/health", timeout=aiohttp.ClientTimeout(total=5)) as response:
+            if response.status == 200:
+                return await response.json()
+            else:
+                return {"status": "unhealthy", "error": f"HTTP {response.status}"}
     except Exception as e:
         return {"status": "unreachable", "error": str(e)}
 
 async def call_gpu_worker(image_data: bytes, prompt: str = "Describe this image in detail.") -> dict:
     """Send image to GPU worker for processing"""
     try:
-        # Prepare multipart form data
-        data = aiohttp.FormData()
-        data.add_field('file', io.BytesIO(image_data), filename='image.jpg', content_type='image/jpeg')
-        data.add_field('prompt', prompt)
+        # Send the raw bytes (no multipart encoding or extra payload copies)
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "X-Prompt": quote(prompt)
+        }
         
         # Send request to GPU worker
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{GPU_WORKER_URL}/caption", data=data, timeout=30) as response:
+        async with gpu_session.post(f"{GPU_WORKER_URL}/caption-raw", data=image_data, headers=headers) as response:
+            
+            if response.status == 200:
+                return await response.json()
+            else:
+                error_text = await response.text()
+                return {
+                    "success": False,
+                    "error": f"GPU Worker error ({response.status}): {error_text}"
+                }
                 
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    error_text = await response.text()
-                    return {
-                        "success": False,
-                        "error": f"GPU Worker error ({response.status}): {error_text}"
-                    }
-                    
     except asyncio.TimeoutError:
         return {"success": False, "error": "GPU worker timeout"}
     except Exception as e:
@@ -165,13 +198,15 @@ async def generate_caption(
     Returns:
         CaptionResponse with generated caption
     """
-    start_time = asyncio.get_event_loop().time()
+    start_time = asyncio.get_running_loop().time()
     
     try:
         logger.info(f"📸 Caption request: {file.filename}, prompt: '{prompt}'")
         
-        # Read image data
-        image_data = await file.read()
+        # Read image data (bounded: anything past the limit fails validation)
+        image_data = await file.read(MAX_IMAGE_SIZE + 1)
+        # Release the spooled upload before the long GPU worker round-trip
+        await file.close()
         
         # Validate image
         if not validate_image(image_data):
@@ -183,7 +218,7 @@ async def generate_caption(
         # Send to GPU worker
         result = await call_gpu_worker(image_data, prompt)
         
-        processing_time = asyncio.get_event_loop().time() - start_time
+        processing_time = asyncio.get_running_loop().time() - start_time
         
         if result.get("success"):
             logger.info(f"✅ Caption generated in {processing_time:.2f}s: {result.get('caption', '')[:50]}...")
@@ -203,7 +238,7 @@ async def generate_caption(
     except HTTPException:
         raise
     except Exception as e:
-        processing_time = asyncio.get_event_loop().time() - start_time
+        processing_time = asyncio.get_running_loop().time() - start_time
         logger.error(f"❌ Caption error: {e}")
         return CaptionResponse(
             success=False,
@@ -222,10 +257,11 @@ async def generate_caption_base64(request: dict):
     Returns:
         CaptionResponse with generated caption
     """
-    start_time = asyncio.get_event_loop().time()
+    start_time = asyncio.get_running_loop().time()
     
     try:
-        image_b64 = request.get("image", "")
+        # pop() so the request dict doesn't keep the base64 string alive
+        image_b64 = request.pop("image", "")
         prompt = request.get("prompt", "Describe this image in detail.")
         
         logger.info(f"📸 Base64 caption request, prompt: '{prompt}'")
@@ -233,9 +269,11 @@ async def generate_caption_base64(request: dict):
         # Decode base64 image
         if image_b64.startswith("data:image"):
             # Remove data URL prefix
-            image_b64 = image_b64.split(",")[1]
+            image_b64 = image_b64.split(",", 1)[1]
         
-        image_data = base64.b64decode(image_b64)
+        # SIMD-accelerated decode (AVX2/SSSE3), much faster than stdlib base64
+        image_data = pybase64.b64decode(image_b64, validate=False)
+        del image_b64
         
         # Validate image
         if not validate_image(image_data):
@@ -247,7 +285,7 @@ async def generate_caption_base64(request: dict):
         # Send to GPU worker
         result = await call_gpu_worker(image_data, prompt)
         
-        processing_time = asyncio.get_event_loop().time() - start_time
+        processing_time = asyncio.get_running_loop().time() - start_time
         
         if result.get("success"):
             logger.info(f"✅ Base64 caption generated in {processing_time:.2f}s")
@@ -265,7 +303,7 @@ async def generate_caption_base64(request: dict):
             )
             
     except Exception as e:
-        processing_time = asyncio.get_event_loop().time() - start_time
+        processing_time = asyncio.get_running_loop().time() - start_time
         logger.error(f"❌ Base64 caption error: {e}")
         return CaptionResponse(
             success=False,
@@ -279,14 +317,20 @@ if __name__ == "__main__":
     # Configuration
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", 5000))
+    # The proxy is I/O-bound, so one worker per core scales it linearly
+    workers = int(os.getenv("WORKERS", os.cpu_count() or 1))
     
-    logger.info(f"🚀 Starting SmolVLM Backend on {host}:{port}")
+    logger.info(f"🚀 Starting SmolVLM Backend on {host}:{port} with {workers} workers")
     logger.info(f"🔗 GPU Worker URL: {GPU_WORKER_URL}")
     
     uvicorn.run(
         "main:app",
         host=host,
         port=port,
+        workers=workers,
+        loop="uvloop" if sys.platform != "win32" else "asyncio",  # uvloop has no Windows build
+        http="httptools",
+        lifespan="on",  # Abort instead of serving if the lifespan handler raises
         reload=False,
         log_level="info"
     )
\ No newline at end of file
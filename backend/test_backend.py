@@ -3,26 +3,56 @@ Quick Test Backend - Connects Frontend to GPU Worker
 """
 
 import os
-import io
-import base64
 import asyncio
 import aiohttp
+import pybase64
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from PIL import Image
 import uvicorn
 
 # Configuration
 GPU_WORKER_URL = "http://localhost:8000"  # Your GPU worker
+# Comma-separated; drop "*" to pin CORS to your frontend (test.html opened from disk needs it)
+ALLOWED_ORIGINS = os.getenv(
+    "ALLOWED_ORIGINS",
+    "https://real-time-webcam-vision-language-captioning.vercel.app,*"
+).split(",")
+
+def detect_image_format(image_data: bytes):
+    """Detect JPEG/PNG/WEBP from magic bytes (same check as the main proxy)"""
+    if image_data[:3] == b'\xff\xd8\xff':
+        return 'JPEG'
+    if image_data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'PNG'
+    if image_data[:4] == b'RIFF' and image_data[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled session for every GPU worker call (keep-alive, no per-frame TCP setup)
+    app.state.session = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=120),  # 2 minute timeout
+        connector=aiohttp.TCPConnector(limit=64, keepalive_timeout=60)
+    )
+    yield
+    await app.state.session.close()
 
 # FastAPI app
-app = FastAPI(title="Test Backend", version="1.0.0")
+app = FastAPI(
+    title="Test Backend",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 # CORS - Allow your frontend
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["https://real-time-webcam-vision-language-captioning.vercel.app", "*"],
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -50,21 +80,20 @@ async def root():
 async def health():
     """Check if GPU worker is healthy"""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{GPU_WORKER_URL}/health") as response:
-                if response.status == 200:
-                    gpu_health = await response.json()
-                    return {
-                        "backend": "healthy",
-                        "gpu_worker": gpu_health,
-                        "connection": "success"
-                    }
-                else:
-                    return {
-                        "backend": "healthy", 
-                        "gpu_worker": "unhealthy",
-                        "connection": "failed"
-                    }
+        async with app.state.session.get(f"{GPU_WORKER_URL}/health") as response:
+            if response.status == 200:
+                gpu_health = await response.json()
+                return {
+                    "backend": "healthy",
+                    "gpu_worker": gpu_health,
+                    "connection": "success"
+                }
+            else:
+                return {
+                    "backend": "healthy", 
+                    "gpu_worker": "unhealthy",
+                    "connection": "failed"
+                }
     except Exception as e:
         return {
             "backend": "healthy",
@@ -80,24 +109,19 @@ async def generate_caption(file: UploadFile = File(...)):
         image_data = await file.read()
         print(f"🔍 Received image: {len(image_data)} bytes, content_type: {file.content_type}")
         
-        # Validate image locally first
-        try:
-            test_image = Image.open(io.BytesIO(image_data))
-            print(f"🖼️ Image valid: {test_image.size}, format: {test_image.format}")
-            test_image.verify()  # Verify it's a valid image
-        except Exception as e:
-            print(f"❌ Image validation failed: {e}")
+        # Cheap magic-number check (the GPU worker does the real decode)
+        if detect_image_format(image_data) is None:
+            print(f"❌ Image validation failed: unknown signature {image_data[:12]!r}")
             return CaptionResponse(
                 success=False,
-                error=f"Invalid image format: {str(e)}"
+                error="Invalid image format: expected JPEG, PNG or WEBP"
             )
         
-        # Forward to GPU worker with proper timeout
-        timeout = aiohttp.ClientTimeout(total=120)  # 2 minute timeout
+        # Forward to GPU worker
         data = aiohttp.FormData()
         data.add_field(
             'file', 
-            io.BytesIO(image_data), 
+            image_data,  # bytes are sent as-is, no BytesIO copy
             filename=file.filename or 'image.jpg',
             content_type='image/jpeg'  # Explicitly set content type
         )
@@ -105,27 +129,26 @@ async def generate_caption(file: UploadFile = File(...)):
         
         print(f"🚀 Sending to GPU worker...")
         
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.post(f"{GPU_WORKER_URL}/caption", data=data) as response:
-                print(f"📨 GPU worker response: {response.status}")
+        async with app.state.session.post(f"{GPU_WORKER_URL}/caption", data=data) as response:
+            print(f"📨 GPU worker response: {response.status}")
+            
+            if response.status == 200:
+                result = await response.json()
+                print(f"✅ Caption received: {result.get('caption', '')[:100]}...")
                 
-                if response.status == 200:
-                    result = await response.json()
-                    print(f"✅ Caption received: {result.get('caption', '')[:100]}...")
-                    
-                    return CaptionResponse(
-                        success=result.get("success", True),  # Default to True if not specified
-                        caption=result.get("caption", ""),
-                        processing_time=result.get("processing_time", 0.0),
-                        error=""
-                    )
-                else:
-                    error_text = await response.text()
-                    print(f"❌ GPU worker error: {error_text}")
-                    return CaptionResponse(
-                        success=False,
-                        error=f"GPU worker error ({response.status}): {error_text}"
-                    )
+                return CaptionResponse(
+                    success=result.get("success", True),  # Default to True if not specified
+                    caption=result.get("caption", ""),
+                    processing_time=result.get("processing_time", 0.0),
+                    error=""
+                )
+            else:
+                error_text = await response.text()
+                print(f"❌ GPU worker error: {error_text}")
+                return CaptionResponse(
+                    success=False,
+                    error=f"GPU worker error ({response.status}): {error_text}"
+                )
                     
     except Exception as e:
         return CaptionResponse(
@@ -137,33 +160,31 @@ async def generate_caption(file: UploadFile = File(...)):
 async def caption_webcam(request: CaptionRequest):
     """Caption from base64 webcam image"""
     try:
-        # Decode base64 image
-        image_b64 = request.image
-        if image_b64.startswith("data:image"):
-            image_b64 = image_b64.split(",")[1]
+        # Decode base64 image (strip an optional data-URL prefix in one pass)
+        image_b64 = request.image.partition(",")[2] or request.image
         
-        image_data = base64.b64decode(image_b64)
+        # SIMD-accelerated decode (AVX2/SSSE3)
+        image_data = pybase64.b64decode(image_b64, validate=False)
         
         # Forward to GPU worker
         data = aiohttp.FormData()
-        data.add_field('file', io.BytesIO(image_data), filename='webcam.jpg')
+        data.add_field('file', image_data, filename='webcam.jpg')
         data.add_field('prompt', request.prompt)
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{GPU_WORKER_URL}/caption", data=data) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return CaptionResponse(
-                        success=result.get("success", False),
-                        caption=result.get("caption", ""),
-                        processing_time=result.get("processing_time", 0.0)
-                    )
-                else:
-                    error_text = await response.text()
-                    return CaptionResponse(
-                        success=False,
-                        error=f"GPU worker error: {error_text}"
-                    )
+        async with app.state.session.post(f"{GPU_WORKER_URL}/caption", data=data) as response:
+            if response.status == 200:
+                result = await response.json()
+                return CaptionResponse(
+                    success=result.get("success", False),
+                    caption=result.get("caption", ""),
+                    processing_time=result.get("processing_time", 0.0)
+                )
+            else:
+                error_text = await response.text()
+                return CaptionResponse(
+                    success=False,
+                    error=f"GPU worker error: {error_text}"
+                )
                     
     except Exception as e:
         return CaptionResponse(
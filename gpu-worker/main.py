@@ -6,17 +6,36 @@ Uses SmolVLM-500M for fast real-time image captioning
 
 import os
 import io
+import sys
 import time
 import logging
 import asyncio
+import copy
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from typing import Optional
+from typing import List, Optional, Tuple, Union
+from urllib.parse import unquote
+
+# Must be set before torch initializes CUDA: expandable segments grow one VA region instead of
+# fragmenting into fixed blocks as prompt/image sizes vary, and the GC threshold reclaims cached
+# blocks before fragmentation forces a synchronous cache flush
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF",
+    "expandable_segments:True,max_split_size_mb:128,garbage_collection_threshold:0.8"
+)
+
+import cv2
+import numpy as np
 import torch
+import PIL
 from PIL import Image
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from transformers import Idefics3ForConditionalGeneration, AutoProcessor
+from transformers import Idefics3ForConditionalGeneration, AutoProcessor, BitsAndBytesConfig
 import uvicorn
 
 # Configure logging
@@ -31,6 +50,20 @@ model = None
 processor = None
 device = None
 model_ready = False
+model_quantized = False
+pixel_scale = None  # On-device rescale/normalize constants (CUDA only)
+pixel_mean = None
+pixel_std = None
+pinned_pixels = None  # Reused pinned host staging buffer for pixel uploads (CUDA only)
+copy_stream = None  # Side stream for host-to-device pixel copies
+generation_config = None  # Built once in load_model, reused by every generate() call
+inference_executor = None  # Dedicated inference thread for blocking model.generate calls
+batch_queue = None  # Pending (image, prompt, future, enqueued_at) requests for the batcher
+batch_task = None
+caption_cache = OrderedDict()  # (dHash, mean colour, prompt) -> caption, in LRU order
+
+# Decoded frames are RGB uint8 arrays; PIL images are still accepted (e.g. test images)
+ImageInput = Union[Image.Image, np.ndarray]
 
 # Response models
 class CaptionResponse(BaseModel):
@@ -44,45 +77,198 @@ class HealthResponse(BaseModel):
     model_loaded: bool
     device: str
     model_name: str
+    quantized: bool = False
     gpu_memory_gb: Optional[float] = None
+    gpu_memory_reserved_gb: Optional[float] = None
+    gpu_alloc_retries: Optional[int] = None
 
 # Model configuration - Using smaller, faster model
 MODEL_NAME = "HuggingFaceTB/SmolVLM-500M-Instruct"  # Much faster than 2.2B
-MAX_NEW_TOKENS = 100
-TEMPERATURE = 0.7
+MAX_NEW_TOKENS = int(os.getenv("MAX_NEW_TOKENS", 48))  # Decode cost is linear in generated tokens
+TEMPERATURE = float(os.getenv("TEMPERATURE", 0))  # 0 = greedy decoding
+MAX_IMAGE_DIM = int(os.getenv("MAX_IMAGE_DIM", 1024))  # Longest side after decode and in the processor
+WORKERS = int(os.getenv("WORKERS", 1))  # Each worker loads its own model copy
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", 0))  # 0 = cores / (2 x workers)
+VLM_QUANT = os.getenv("VLM_QUANT", "none").lower()  # none | int8 | nf4 (bitsandbytes, CUDA only)
+CPU_QUANTIZE = os.getenv("CPU_QUANTIZE", "0") == "1"  # Opt-in: INT8 decoder on fp32 CPU path (changes captions)
+ATTN_IMPLEMENTATION = os.getenv("ATTN_IMPLEMENTATION", "sdpa")  # sdpa | flash_attention_2 | eager
+IMAGE_SPLITTING = os.getenv("IMAGE_SPLITTING", "1") == "1"  # 0 = one fixed 512px tile per frame
+TORCH_COMPILE = os.getenv("TORCH_COMPILE", "0")  # 0 = off, 1 = whole model, vision = vision encoder; fixed shapes need IMAGE_SPLITTING=0 + MAX_BATCH_SIZE=1
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 8))  # 1 disables batching
+BATCH_WINDOW_MS = int(os.getenv("BATCH_WINDOW_MS", 20))  # How long to wait for more requests
+MAX_QUEUE_AGE_MS = int(os.getenv("MAX_QUEUE_AGE_MS", 0))  # Drop frames queued longer than this (0 = never)
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024  # 10MB; larger uploads are rejected with 413
+HEADER_PROBE_BYTES = 128 * 1024  # Prefix read to get image dimensions before decoding
+WARMUP_ITERS = int(os.getenv("WARMUP_ITERS", 3))  # Realistic-frame generations before serving, CUDA only (0 = skip)
+GPU_MEMORY_FRACTION = float(os.getenv("GPU_MEMORY_FRACTION", 0.9))  # Cap on this process's share of VRAM
+
+# Resampling filter for the processor's internal resize (LANCZOS is the slowest)
+RESAMPLE_FILTERS = {
+    "bilinear": Image.Resampling.BILINEAR,
+    "lanczos": Image.Resampling.LANCZOS,
+    "box": Image.Resampling.BOX,
+}
+CAPTION_CACHE_SIZE = int(os.getenv("CAPTION_CACHE_SIZE", 128))  # 0 disables the cache
+CAPTION_CACHE_DISTANCE = int(os.getenv("CAPTION_CACHE_DISTANCE", 4))  # Max Hamming distance for a hit
+CAPTION_CACHE_COLOR_DISTANCE = int(os.getenv("CAPTION_CACHE_COLOR_DISTANCE", 12))  # Max per-channel mean difference (0-255)
+RESAMPLE_FILTER = RESAMPLE_FILTERS.get(os.getenv("RESAMPLE_FILTER", "bilinear").lower(), Image.Resampling.BILINEAR)
 
 async def load_model():
     """Load SmolVLM model with proper error handling"""
-    global model, processor, device, model_ready
+    global model, processor, device, model_ready, model_quantized, pixel_scale, pixel_mean, pixel_std, copy_stream
+    global generation_config
     
     try:
         logger.info(f"🔥 Loading {MODEL_NAME}...")
         start_time = time.time()
         
+        # Pin CPU threading: too many intra-op threads thrash L2/L3 on small matmuls.
+        # Rule of thumb is cores / uvicorn workers, halved to leave room for the event loop.
+        num_threads = TORCH_NUM_THREADS or max(1, (os.cpu_count() or 2) // (2 * WORKERS))
+        torch.set_num_threads(num_threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass  # Can only be set once per process
+        logger.info(f"🧵 Torch threads: {num_threads} intra-op, 1 inter-op")
+        
         # Setup device
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         logger.info(f"Using device: {device}")
         
         if device.type == "cpu":
             logger.warning("⚠️ No GPU detected! Using CPU (will be slower)")
+        else:
+            # Vision tiles are always 512x512, so cuDNN autotuning picks one algorithm and keeps it
+            torch.backends.cudnn.benchmark = True
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            torch.set_float32_matmul_precision("high")
+            torch.cuda.set_per_process_memory_fraction(GPU_MEMORY_FRACTION)
+            logger.info(f"🧮 CUDA allocator: {os.environ['PYTORCH_CUDA_ALLOC_CONF']}, {GPU_MEMORY_FRACTION:.0%} of VRAM")
+        
+        # Pillow-SIMD builds carry a .postN suffix
+        if ".post" in PIL.__version__:
+            logger.info(f"🖼️ Using Pillow-SIMD {PIL.__version__}")
+        else:
+            logger.info(f"🖼️ Using stock Pillow {PIL.__version__} (install pillow-simd for faster resizing)")
         
         # Load processor first
         logger.info("📥 Loading processor...")
         processor = AutoProcessor.from_pretrained(MODEL_NAME, trust_remote_code=True)
+        # Batched generation needs prompts aligned on the right
+        processor.tokenizer.padding_side = "left"
+        processor.image_processor.resample = RESAMPLE_FILTER
+        # The processor would otherwise upscale every frame to 2048px (up to 16 tiles + global);
+        # matching the decode cap makes its resize a no-op for frames already at MAX_IMAGE_DIM
+        processor.image_processor.size = {"longest_edge": MAX_IMAGE_DIM}
+        # Without splitting every frame becomes exactly one 512x512 tile (64 image tokens); with
+        # MAX_BATCH_SIZE=1 as well, input shapes stay constant and compiled graphs never see a new shape
+        processor.image_processor.do_image_splitting = IMAGE_SPLITTING
+        
+        if device.type == "cuda":
+            # Pixels are shipped as uint8 and normalized on the GPU (see normalize_pixels_on_device)
+            image_processor = processor.image_processor
+            pixel_scale = image_processor.rescale_factor
+            pixel_mean = torch.tensor(image_processor.image_mean, device=device).view(1, 1, 3, 1, 1)
+            pixel_std = torch.tensor(image_processor.image_std, device=device).view(1, 1, 3, 1, 1)
+            copy_stream = torch.cuda.Stream()
+        
+        # Pick dtype: bf16 on Ampere+ GPUs (no fp16 softmax overflow), fp16 on older GPUs,
+        # bf16 on CPUs with native bf16 (AVX512-BF16/AMX), else fp32
+        if device.type == "cuda":
+            dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        elif torch.cpu._is_avx512_bf16_supported():
+            dtype = torch.bfloat16
+        else:
+            dtype = torch.float32
+        
+        # Optional weight-only quantization: the decoder is bound by weight reads per token
+        quantization_config = None
+        if VLM_QUANT not in ("none", "int8", "nf4"):
+            raise ValueError(f"Unsupported VLM_QUANT={VLM_QUANT!r} (expected none, int8 or nf4)")
+        if VLM_QUANT != "none" and device.type != "cuda":
+            logger.warning(f"⚠️ VLM_QUANT={VLM_QUANT} needs a GPU, loading unquantized weights")
+        elif VLM_QUANT == "int8":
+            quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+        elif VLM_QUANT == "nf4":
+            quantization_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=dtype,
+                bnb_4bit_use_double_quant=True
+            )
         
         # Load model with appropriate settings
-        logger.info("📥 Loading model...")
+        logger.info(f"📥 Loading model ({dtype}, {ATTN_IMPLEMENTATION} attention, quant={VLM_QUANT})...")
         model = Idefics3ForConditionalGeneration.from_pretrained(
             MODEL_NAME,
-            torch_dtype=torch.float16 if device.type == "cuda" else torch.float32,
-            device_map="auto" if device.type == "cuda" else None,
+            torch_dtype=dtype,  # Still used for the modules bitsandbytes leaves unquantized
+            attn_implementation=ATTN_IMPLEMENTATION,
+            quantization_config=quantization_config,
+            # 500M fits on one device: no device_map="auto" means no accelerate dispatch hooks
+            # on every layer. bitsandbytes quantizes while loading, so it needs a target device
+            # (a single-device map installs no hooks either).
+            device_map={"": device} if quantization_config is not None else None,
+            low_cpu_mem_usage=True,
             trust_remote_code=True
         )
         
-        if device.type == "cpu":
+        if quantization_config is None:
             model = model.to(device)
+        logger.info(f"📍 Model parameters on {next(model.parameters()).device}")
         
         model.eval()
+        # This worker never trains: frozen weights keep autograd out of any forward that
+        # escapes inference_mode (e.g. torch.compile tracing)
+        model.requires_grad_(False)
+        model_quantized = quantization_config is not None
+        
+        # Opt-in (CPU_QUANTIZE=1) dynamic INT8 quantization of the text decoder's Linear layers
+        # on the fp32 CPU path (FBGEMM uses VNNI where available). The vision encoder stays in fp32.
+        engines = torch.backends.quantized.supported_engines
+        if CPU_QUANTIZE and dtype == torch.float32 and ("fbgemm" in engines or "qnnpack" in engines):
+            torch.backends.quantized.engine = "fbgemm" if "fbgemm" in engines else "qnnpack"
+            model.model.text_model = torch.ao.quantization.quantize_dynamic(
+                model.model.text_model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+            model_quantized = True
+            logger.info(f"🗜️ Text decoder quantized to INT8 ({torch.backends.quantized.engine})")
+        
+        if TORCH_COMPILE != "0":
+            # The tile side is fixed at 512px but the tile count is not: splitting gives a
+            # frame-dependent number of tiles (e.g. 5 for 640x480) and batching multiplies it,
+            # so reduce-overhead records a CUDA graph per distinct shape
+            if IMAGE_SPLITTING or MAX_BATCH_SIZE > 1:
+                logger.warning("⚠️ TORCH_COMPILE with variable input shapes; set IMAGE_SPLITTING=0 "
+                               "and MAX_BATCH_SIZE=1 for a single compiled graph")
+            # Compiled on the first generate call, i.e. during test_model() at startup
+            try:
+                if TORCH_COMPILE == "vision":
+                    model.model.vision_model = torch.compile(model.model.vision_model, mode="reduce-overhead")
+                else:
+                    if model._supports_static_cache:
+                        model.generation_config.cache_implementation = "static"
+                    model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+                logger.info(f"⚙️ torch.compile enabled ({TORCH_COMPILE}, reduce-overhead)")
+            except Exception as e:
+                logger.warning(f"⚠️ torch.compile unavailable, using eager mode: {e}")
+        
+        # Build the generation settings once instead of re-validating kwargs on every call.
+        # Starting from the model's config keeps its defaults (and the static cache set above).
+        eos_token_id = processor.tokenizer.eos_token_id
+        generation_config = copy.deepcopy(model.generation_config)
+        generation_config.update(
+            max_new_tokens=MAX_NEW_TOKENS,
+            min_new_tokens=1,
+            do_sample=TEMPERATURE > 0,
+            num_beams=1,
+            use_cache=True,
+            pad_token_id=eos_token_id,
+            eos_token_id=eos_token_id
+        )
+        if TEMPERATURE > 0:
+            generation_config.temperature = TEMPERATURE
         
         load_time = time.time() - start_time
         logger.info(f"✅ Model loaded successfully in {load_time:.2f}s")
@@ -112,55 +298,280 @@ async def test_model():
         caption = await generate_caption_internal(test_image, "What color is this image?")
         
         logger.info(f"✅ Model test successful: {caption}")
+        
+        # Warm up on webcam-sized frames (bypassing the caption cache) so cuDNN autotuning,
+        # allocator growth and any torch.compile work finish before real traffic. The CPU
+        # path has none of that state, and each pass there would only delay readiness.
+        if device.type == "cuda" and WARMUP_ITERS > 0:
+            warmup_start = time.time()
+            warmup_frame = np.full((480, 640, 3), 128, dtype=np.uint8)
+            loop = asyncio.get_running_loop()
+            for _ in range(WARMUP_ITERS):
+                await loop.run_in_executor(
+                    inference_executor, _generate_captions_sync, [warmup_frame], ["Describe this image in detail."]
+                )
+            logger.info(f"🔥 Warmup: {WARMUP_ITERS} generations in {time.time() - warmup_start:.2f}s")
         return True
         
     except Exception as e:
         logger.error(f"❌ Model test failed: {e}")
         return False
 
-async def generate_caption_internal(image: Image.Image, prompt: str = "Describe this image.") -> str:
-    """Internal caption generation function"""
+def decode_image(image_data: Union[bytes, bytearray]) -> np.ndarray:
+    """Decode and downscale an upload with OpenCV (libjpeg-turbo + SIMD INTER_AREA resize)
+
+    Returns an RGB HxWx3 uint8 array that is handed to the processor as-is,
+    avoiding a PIL round-trip and its extra copy of the pixels.
+    """
+    # Header-only read to pick a reduced decode scale (libjpeg DCT scaling for JPEG).
+    # BytesIO copies non-bytes input, so probe a bounded slice (enough for a JPEG
+    # with a full 64KB EXIF block) and only fall back to the whole buffer if that fails.
     try:
-        # Prepare the conversation format that SmolVLM expects
-        messages = [
-            {
-                "role": "user", 
-                "content": [
-                    {"type": "image"},
-                    {"type": "text", "text": prompt}
-                ]
-            }
-        ]
-        
-        # Apply chat template
-        text_prompt = processor.apply_chat_template(messages, add_generation_prompt=True)
-        
-        # Process image and text
-        inputs = processor(text=text_prompt, images=[image], return_tensors="pt")
-        inputs = inputs.to(device)
-        
-        # Generate response
-        with torch.no_grad():
-            generated_ids = model.generate(
-                **inputs,
-                max_new_tokens=MAX_NEW_TOKENS,
-                temperature=TEMPERATURE,
-                do_sample=True,
-                pad_token_id=processor.tokenizer.eos_token_id
+        with Image.open(io.BytesIO(image_data[:HEADER_PROBE_BYTES])) as header:
+            width, height = header.size
+    except Exception:
+        with Image.open(io.BytesIO(image_data)) as header:
+            width, height = header.size
+    
+    flag = cv2.IMREAD_COLOR
+    for factor, reduced_flag in ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                                 (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                 (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if max(width, height) // factor >= MAX_IMAGE_DIM:
+            flag = reduced_flag
+            break
+    
+    image = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), flag)
+    is_bgr = image is not None
+    if image is None:
+        # OpenCV has no GIF decoder; fall back to PIL for formats it can't read
+        # (rare path, so the BytesIO copy of the upload is acceptable here)
+        with Image.open(io.BytesIO(image_data)) as pil_image:
+            image = np.asarray(pil_image.convert("RGB"))
+    
+    height, width = image.shape[:2]
+    scale = MAX_IMAGE_DIM / max(height, width)
+    if scale < 1.0:
+        image = cv2.resize(
+            image,
+            (max(1, int(width * scale)), max(1, int(height * scale))),
+            interpolation=cv2.INTER_AREA
+        )
+    
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB) if is_bgr else image
+
+def dhash(image: ImageInput, hash_size: int = 8) -> Tuple[int, Tuple[int, ...]]:
+    """Difference hash plus mean colour: a fingerprint that survives small frame-to-frame changes
+
+    The 64 gradient bits ignore absolute brightness, so every flat frame (covered
+    lens, lights off, blank wall) hashes to 0; the mean colour tells those apart.
+    """
+    small = cv2.resize(np.asarray(image), (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+    
+    # One bit per pixel: is it brighter than its right-hand neighbour?
+    bits = gray[:, :-1] > gray[:, 1:]
+    image_hash = int.from_bytes(np.packbits(bits).tobytes(), 'big')
+    mean_colour = tuple(int(c) for c in small.reshape(-1, 3).mean(axis=0))
+    return image_hash, mean_colour
+
+def get_cached_caption(fingerprint: Tuple[int, Tuple[int, ...]], prompt: str) -> Optional[str]:
+    """Return the caption of a recent near-identical frame, if any"""
+    image_hash, mean_colour = fingerprint
+    for key in reversed(caption_cache):
+        cached_hash, cached_colour, cached_prompt = key
+        if (cached_prompt == prompt
+                and (cached_hash ^ image_hash).bit_count() <= CAPTION_CACHE_DISTANCE
+                and max(abs(a - b) for a, b in zip(cached_colour, mean_colour)) <= CAPTION_CACHE_COLOR_DISTANCE):
+            caption_cache.move_to_end(key)
+            return caption_cache[key]
+    return None
+
+def cache_caption(fingerprint: Tuple[int, Tuple[int, ...]], prompt: str, caption: str):
+    """Store a caption, evicting the least recently used entry when full"""
+    key = (*fingerprint, prompt)
+    caption_cache[key] = caption
+    caption_cache.move_to_end(key)
+    if len(caption_cache) > CAPTION_CACHE_SIZE:
+        caption_cache.popitem(last=False)
+
+async def generate_caption_internal(image: ImageInput, prompt: str = "Describe this image.") -> str:
+    """Internal caption generation function (queued for the batcher)"""
+    # Webcam streams send many near-identical frames; reuse their caption
+    if CAPTION_CACHE_SIZE > 0:
+        fingerprint = dhash(image)
+        caption = get_cached_caption(fingerprint, prompt)
+        if caption is not None:
+            return caption
+    
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    await batch_queue.put((image, prompt, future, loop.time()))
+    caption = await future
+    
+    if CAPTION_CACHE_SIZE > 0:
+        cache_caption(fingerprint, prompt, caption)
+    return caption
+
+async def batch_loop():
+    """Coalesce requests arriving within BATCH_WINDOW_MS into one generate call"""
+    loop = asyncio.get_running_loop()
+    
+    while True:
+        batch = [await batch_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_MS / 1000
+        
+        while len(batch) < MAX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        # Skip abandoned requests and frames that are too old to be worth captioning;
+        # the client's next frame is fresher than anything still waiting here
+        now = loop.time()
+        fresh = []
+        for item in batch:
+            future, enqueued_at = item[2], item[3]
+            if future.done():
+                continue
+            if MAX_QUEUE_AGE_MS > 0 and (now - enqueued_at) * 1000 > MAX_QUEUE_AGE_MS:
+                future.set_exception(TimeoutError("Frame dropped: waited too long in the inference queue"))
+                continue
+            fresh.append(item)
+        
+        if not fresh:
+            continue
+        
+        images, prompts, futures, _ = zip(*fresh)
+        
+        try:
+            captions = await loop.run_in_executor(
+                inference_executor, _generate_captions_sync, list(images), list(prompts)
             )
+        except Exception as e:
+            if len(fresh) == 1:
+                if not futures[0].done():
+                    futures[0].set_exception(e)
+                continue
+            # One bad frame must not fail other clients' requests: retry the batch
+            # item by item so only the frame that actually fails gets the error
+            logger.warning("⚠️ Batch of %d failed (%s), retrying individually", len(fresh), e)
+            for image, prompt, future, _ in fresh:
+                if future.done():
+                    continue
+                try:
+                    (caption,) = await loop.run_in_executor(
+                        inference_executor, _generate_captions_sync, [image], [prompt]
+                    )
+                except Exception as item_error:
+                    if not future.done():
+                        future.set_exception(item_error)
+                else:
+                    if not future.done():
+                        future.set_result(caption)
+        else:
+            for future, caption in zip(futures, captions):
+                if not future.done():
+                    future.set_result(caption)
+
+@functools.lru_cache(maxsize=64)
+def build_text_prompt(prompt: str) -> str:
+    """Render the chat template once per distinct prompt (Jinja is slow per call)"""
+    # Prepare the conversation format that SmolVLM expects
+    messages = [
+        {
+            "role": "user", 
+            "content": [
+                {"type": "image"},
+                {"type": "text", "text": prompt}
+            ]
+        }
+    ]
+    
+    # Apply chat template
+    return processor.apply_chat_template(messages, add_generation_prompt=True)
+
+def stage_pixels_to_device(pixel_values: torch.Tensor) -> torch.Tensor:
+    """Copy pixels to the GPU through a reused pinned buffer on a side stream"""
+    global pinned_pixels
+    
+    # Grow the pinned buffer only when a bigger batch arrives (pinning memory is expensive)
+    numel = pixel_values.numel()
+    if pinned_pixels is None or pinned_pixels.numel() < numel or pinned_pixels.dtype != pixel_values.dtype:
+        pinned_pixels = torch.empty(numel, dtype=pixel_values.dtype, pin_memory=True)
+    staging = pinned_pixels[:numel].view(pixel_values.shape)
+    staging.copy_(pixel_values)
+    
+    # Async DMA on the copy stream; compute waits for it before touching the pixels
+    with torch.cuda.stream(copy_stream):
+        gpu_pixels = staging.to(device, non_blocking=True)
+    torch.cuda.current_stream().wait_stream(copy_stream)
+    gpu_pixels.record_stream(torch.cuda.current_stream())
+    return gpu_pixels
+
+def normalize_pixels_on_device(pixel_values: torch.Tensor, pixel_attention_mask: Optional[torch.Tensor]) -> torch.Tensor:
+    """Rescale + normalize uint8 tiles on the GPU (4x less host-to-device traffic than fp32)"""
+    pixel_values = stage_pixels_to_device(pixel_values)
+    pixel_values = (pixel_values.float() * pixel_scale - pixel_mean) / pixel_std
+    
+    # Padding tiles must stay all-zero so the model can recognise and drop them
+    if pixel_attention_mask is not None:
+        real_tiles = pixel_attention_mask.flatten(2).any(-1)
+        pixel_values = pixel_values * real_tiles[:, :, None, None, None]
+    
+    return pixel_values.to(model.dtype)
+
+@torch.inference_mode()
+def _generate_captions_sync(images: List[ImageInput], prompts: List[str]) -> List[str]:
+    """Blocking batched caption generation, executed in the inference thread pool
+
+    The whole function runs under inference_mode, so tensor work outside
+    generate() (processor output, on-device normalization) also skips
+    autograd version counters and view tracking.
+    """
+    try:
+        text_prompts = [build_text_prompt(prompt) for prompt in prompts]
+        
+        # Process images and text (one image per prompt); on CUDA, normalization happens on-device
+        normalize_on_device = device.type == "cuda"
+        inputs = processor(
+            text=text_prompts,
+            images=[[image] for image in images],
+            return_tensors="pt",
+            padding=True,
+            do_rescale=not normalize_on_device,
+            do_normalize=not normalize_on_device
+        )
         
-        # Decode response
-        generated_text = processor.batch_decode(
+        if normalize_on_device:
+            pixel_values = inputs.pop("pixel_values")
+            inputs = inputs.to(device)
+            inputs["pixel_values"] = normalize_pixels_on_device(pixel_values, inputs.get("pixel_attention_mask"))
+        else:
+            inputs = inputs.to(device)
+        
+        # Generate responses
+        generated_ids = model.generate(**inputs, generation_config=generation_config)
+        
+        # Decode only the new tokens of each sequence
+        generated_texts = processor.batch_decode(
             generated_ids[:, inputs['input_ids'].shape[1]:], 
             skip_special_tokens=True
-        )[0]
+        )
         
-        # Clean up the response
-        caption = generated_text.strip()
-        if not caption:
-            caption = "I can see an image but cannot describe it clearly."
+        # Clean up the responses
+        captions = []
+        for generated_text in generated_texts:
+            caption = generated_text.strip()
+            if not caption:
+                caption = "I can see an image but cannot describe it clearly."
+            captions.append(caption)
             
-        return caption
+        return captions
         
     except Exception as e:
         logger.error(f"❌ Caption generation failed: {e}")
@@ -170,7 +581,16 @@ async def generate_caption_internal(image: Image.Image, prompt: str = "Describe
 async def lifespan(app: FastAPI):
     """Manage application lifespan"""
     # Startup
+    global inference_executor, batch_queue, batch_task
     logger.info("🚀 Starting SmolVLM GPU Worker...")
+    logger.info(f"⚡ Event loop: {type(asyncio.get_running_loop()).__module__}")
+    
+    # Only the batcher submits work, one batch at a time, so a single thread is enough
+    inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vlm")
+    
+    # Start the batcher before load_model() so test_model() can use it
+    batch_queue = asyncio.Queue()
+    batch_task = asyncio.create_task(batch_loop())
     
     if not await load_model():
         raise Exception("Failed to load model")
@@ -179,13 +599,16 @@ async def lifespan(app: FastAPI):
     
     # Shutdown
     logger.info("🛑 Shutting down GPU Worker...")
+    batch_task.cancel()
+    inference_executor.shutdown(wait=False)
 
 # Create FastAPI app
 app = FastAPI(
     title="SmolVLM GPU Worker",
     description="Fast GPU worker for SmolVLM-500M image captioning",
     version="2.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware
@@ -211,15 +634,24 @@ async def root():
 async def health_check():
     """Health check endpoint"""
     gpu_memory = None
+    gpu_reserved = None
+    alloc_retries = None
     if torch.cuda.is_available():
-        gpu_memory = round(torch.cuda.memory_allocated() / 1e9, 2)
+        # Allocated vs reserved shows fragmentation; retries count the slow cache-flush path
+        stats = torch.cuda.memory_stats()
+        gpu_memory = round(stats.get("allocated_bytes.all.current", 0) / 1e9, 2)
+        gpu_reserved = round(stats.get("reserved_bytes.all.current", 0) / 1e9, 2)
+        alloc_retries = stats.get("num_alloc_retries", 0)
     
     return HealthResponse(
         status="healthy" if model_ready else "loading",
         model_loaded=model_ready,
         device=str(device) if device else "unknown",
         model_name=MODEL_NAME,
-        gpu_memory_gb=gpu_memory
+        quantized=model_quantized,
+        gpu_memory_gb=gpu_memory,
+        gpu_memory_reserved_gb=gpu_reserved,
+        gpu_alloc_retries=alloc_retries
     )
 
 @app.post("/caption", response_model=CaptionResponse)
@@ -231,59 +663,78 @@ async def generate_caption(
     if not model_ready:
         raise HTTPException(status_code=503, detail="Model not ready")
     
+    # Bounded read: anything past the limit is never copied into memory
+    image_data = await file.read(MAX_UPLOAD_BYTES + 1)
+    await file.close()
+    
+    return await caption_image_data(image_data, prompt)
+
+@app.post("/caption-raw", response_model=CaptionResponse)
+async def generate_caption_raw(request: Request):
+    """Generate caption for a raw image body (prompt in the URL-encoded X-Prompt header)"""
+    if not model_ready:
+        raise HTTPException(status_code=503, detail="Model not ready")
+    
+    # Stream the body and stop one byte past the limit instead of buffering it all
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > MAX_UPLOAD_BYTES:
+            break
+    prompt = unquote(request.headers.get("X-Prompt", "Describe this image in detail."))
+    
+    # Passed as-is rather than via bytes(body), so no second full copy lives through inference;
+    # cv2 reads it through np.frombuffer and the header probe only copies a bounded slice
+    return await caption_image_data(body, prompt)
+
+async def caption_image_data(image_data: Union[bytes, bytearray], prompt: str) -> CaptionResponse:
+    """Validate, decode and caption uploaded image bytes"""
     start_time = time.time()
     
     try:
-        # Read image data first
-        image_data = await file.read()
+        # Size bounds first: known-bad uploads never reach the decoder
+        size = len(image_data)
+        if size < 100:  # Too small to be a real image
+            raise HTTPException(status_code=400, detail="Image data too small")
         
-        # Validate by trying to open with PIL (more reliable than content-type)
+        if size > MAX_UPLOAD_BYTES:  # Reads stop at MAX_UPLOAD_BYTES + 1
+            raise HTTPException(status_code=413, detail="Image too large (max 10MB)")
+        
+        # Validate by decoding (more reliable than content-type)
         try:
-            image = Image.open(io.BytesIO(image_data)).convert('RGB')
+            image = decode_image(image_data)
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Invalid image data: {str(e)}")
         
-        # Additional size validation
-        if len(image_data) < 100:  # Too small to be a real image
-            raise HTTPException(status_code=400, detail="Image data too small")
-        
-        if len(image_data) > 10 * 1024 * 1024:  # Larger than 10MB
-            raise HTTPException(status_code=400, detail="Image too large (max 10MB)")
-        
-        logger.info(f"📸 Processing image: {image.size}, prompt: '{prompt[:50]}...'")
+        # Hot path: %-style args are only formatted if the record is emitted
+        logger.debug("📸 Processing image: %dx%d, prompt: %r", image.shape[1], image.shape[0], prompt[:50])
         
         # Generate caption
         caption = await generate_caption_internal(image, prompt)
         
         processing_time = time.time() - start_time
         
-        logger.info(f"✅ Caption generated in {processing_time:.2f}s: {caption[:100]}...")
+        # One INFO line per request; the caption text itself is DEBUG only
+        logger.info("✅ caption %dx%d t=%.3fs len=%d", image.shape[1], image.shape[0], processing_time, len(caption))
+        logger.debug("📤 Caption: %s", caption)
         
-        response = CaptionResponse(
+        return CaptionResponse(
             success=True,
             caption=caption,
             processing_time=round(processing_time, 3)
         )
         
-        # Log the response for debugging
-        logger.info(f"📤 Returning response: success={response.success}, caption_length={len(caption)}")
-        
-        return response
-        
     except HTTPException:
         raise
     except Exception as e:
         processing_time = time.time() - start_time
-        logger.error(f"❌ Caption generation failed: {e}")
+        logger.error("❌ Caption generation failed after %.3fs: %s", processing_time, e)
         
-        response = CaptionResponse(
+        return CaptionResponse(
             success=False,
             error=str(e),
             processing_time=round(processing_time, 3)
         )
-        
-        logger.info(f"📤 Returning error response: {response.error}")
-        return response
 
 @app.get("/test")
 async def test_endpoint():
@@ -317,10 +768,16 @@ if __name__ == "__main__":
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", 8000))
     
+    # RAM/VRAM use is WORKERS x model size; keep 1 when sharing a single GPU
     uvicorn.run(
         "main:app",
         host=host,
         port=port,
+        workers=WORKERS,
+        loop="uvloop" if sys.platform != "win32" else "asyncio",  # uvloop has no Windows build
+        http="httptools",
+        lifespan="on",  # Abort instead of serving if the lifespan handler raises
         reload=False,
-        log_level="info"
+        log_level="warning",  # Startup/model logs come from our own logger
+        access_log=False  # No per-request access line on the hot path
     )
\ No newline at end of file